@@ -0,0 +1,55 @@
+""" compare CRUD.create and CRUD.bulk_insert throughput with and without sqlite_profile
+
+Run from the repository root: python benchmarks/sqlite_profile.py [creates] [bulk rows]
+"""
+from contextlib import redirect_stdout
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlangelo import SQLAngelo  # noqa: E402
+
+
+def run(folder, sqlite_profile, creates, bulk_rows):
+    name = 'profile.sqlite3' if sqlite_profile else 'default.sqlite3'
+    uri = 'sqlite:///' + os.path.join(folder, name)
+    db = SQLAngelo(flask.Flask('benchmark'), uri, sqlite_profile=sqlite_profile)
+
+    class Item(db.BaseModel):
+        name = db.Column(db.Unicode(20))
+
+    db.create_all()
+    start = time.time()
+    for i in range(creates):
+        Item.create(name=u'create %d' % i, report=False)
+    create_rate = creates / (time.time() - start)
+
+    records = [dict(name=u'bulk %d' % i) for i in range(bulk_rows)]
+    start = time.time()
+    with redirect_stdout(io.StringIO()):  # bulk_insert prints its records
+        Item.bulk_insert(records)
+    bulk_rate = bulk_rows / (time.time() - start)
+    db.session.remove()
+    db.engine.dispose()
+    return create_rate, bulk_rate
+
+
+def main(creates=2000, bulk_rows=20000):
+    folder = tempfile.mkdtemp()
+    try:
+        for sqlite_profile in (None, True):
+            create_rate, bulk_rate = run(folder, sqlite_profile, creates, bulk_rows)
+            print('%-15s create: %7.0f/s   bulk_insert: %8.0f rows/s'
+                  % ('sqlite_profile' if sqlite_profile else 'default', create_rate, bulk_rate))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,16 +1,51 @@
 """ Wrapper around Flask-SQLAlchemy and friends """
+from contextlib import contextmanager
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
-from . import decorators, mixins, types
+from sqlalchemy import event, pool
+from . import buffering, decorators, mixins, profiling, types
+
+SQLITE_PROFILE = dict(
+    journal_mode='WAL',
+    synchronous='NORMAL',
+    mmap_size=256 * 1024 * 1024,
+    cache_size=-64 * 1024,  # negative means KiB rather than pages
+    temp_store='MEMORY',
+    busy_timeout=5000,  # ms
+)
+
 
 class SQLAngelo(SQLAlchemy):
 
-    def __init__(self, app, db_uri, debug=False):  # noqa: C901
+    def __init__(self, app, db_uri, debug=False, sqlite_profile=None,  # noqa: C901
+                 profile=False, slow_query_threshold=None):
         """ Args:
         app (Flask app)
         db_uri: URI of database
         debug (boolean): if true, logs extra debugging information
+        sqlite_profile (boolean or dict): if set, apply tuned PRAGMAs to every SQLite connection
+            (True for SQLITE_PROFILE, or a dict of PRAGMAs to override it)
+        profile (boolean): if true, time every statement (see query_stats)
+        slow_query_threshold (float): if set, log statements taking longer (in seconds)
+            with their query plan (implies profile)
         """
 
+        self._writer = None
+        self._snapshot = None
+        self._session_listeners = []  # (event name, function), see listen_session
+
+        # configure statement timing (installed in get_engine)
+        self.profiler = None
+        if profile or slow_query_threshold is not None:
+            self.profiler = profiling.Profiler(self, slow_query_threshold)
+
+        # configure SQLite tuning (applied in apply_driver_hacks and get_engine)
+        if sqlite_profile is True:
+            sqlite_profile = {}
+        if sqlite_profile is not None:
+            sqlite_profile = dict(SQLITE_PROFILE, **sqlite_profile)
+        self.sqlite_profile = sqlite_profile
+
         # configure debug logging
         self.echo = debug
         from . import base
@@ -31,7 +66,184 @@ class SQLAngelo(SQLAlchemy):
         self.mixins = mixins
         self.types = types
 
+    def apply_driver_hacks(self, app, sa_url, options):
+        """ pool SQLite connections when a profile is set, so PRAGMAs and caches are reused """
+        rv = super(SQLAngelo, self).apply_driver_hacks(app, sa_url, options)
+        if self.sqlite_profile is not None and sa_url.drivername.startswith('sqlite'):
+            if sa_url.database in (None, '', ':memory:'):
+                options['poolclass'] = pool.StaticPool
+            else:
+                options['poolclass'] = pool.QueuePool
+                options.setdefault('pool_size', 5)
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return rv
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(SQLAngelo, self).get_engine(app, bind)
+        if (self.sqlite_profile is not None and engine.dialect.name == 'sqlite'
+                and not getattr(engine, 'sqlite_profiled', False)):
+            self._apply_sqlite_profile(engine)
+        if self.profiler is not None and not getattr(engine, 'profiled', False):
+            engine.profiled = True
+            self.profiler.install(engine)
+        return engine
+
+    def create_session(self, options):
+        """ session factory, with the listeners registered by listen_session """
+        factory = super(SQLAngelo, self).create_session(options)
+        for name, fn in self._session_listeners:
+            event.listen(factory, name, fn)
+        return factory
+
+    def listen_session(self, name, fn):
+        """ listen to an event of the sessions of this database only
+
+        Unlike listening to the Session class, this leaves other databases and plain
+        sessions (e.g. of the buffered writer) alone, and covers the sessions of transaction.
+        """
+        self._session_listeners.append((name, fn))
+        event.listen(self.session, name, fn)
+
+    def writer(self, **options):
+        """ the shared write-behind writer, used by CRUD.create_async_buffered
+
+        Args:
+            options: keyword arguments for buffering.BufferedWriter, to start a new writer
+                (at first use or after closing the previous one)
+        Returns:
+            BufferedWriter
+        Raises:
+            ValueError: if options are given while a writer is running
+        """
+        if self._writer is None or self._writer.closed:
+            self._writer = buffering.BufferedWriter(self, **options)
+        elif options:
+            raise ValueError('A writer is already running, close it before changing options')
+        return self._writer
+
+    def query_stats(self):
+        """ statement statistics per model and operation (requires profile)
+
+        Returns:
+            dict of (model name, operation) to dict of count, p50, p95, max (seconds) and
+            affected_rows (inserted, updated or deleted; SELECTs count none)
+        """
+        return self._get_profiler().stats()
+
+    def reset_query_stats(self):
+        """ forget the statistics collected so far """
+        self._get_profiler().reset()
+
+    def _get_profiler(self):
+        if self.profiler is None:
+            raise RuntimeError('Profiling is off, pass profile=True or slow_query_threshold')
+        return self.profiler
+
+    def _apply_sqlite_profile(self, engine):
+        """ set PRAGMAs on each new connection and serialize writers
+
+        pysqlite defers BEGIN until the first write and then takes a shared lock, so
+        concurrent writers fail halfway through their transaction. Instead we take the
+        write lock up front (BEGIN IMMEDIATE) and let busy_timeout queue the writers.
+        """
+        profile = self.sqlite_profile
+        engine.sqlite_profiled = True
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in profile.items():
+                cursor.execute('PRAGMA %s = %s' % (pragma, value))
+            cursor.close()
+            dbapi_connection.isolation_level = 'IMMEDIATE'
+
     def init(self):
         ''' (re)create the database '''
+        self.session.remove()  # an open transaction would lock the tables
         self.drop_all()
         self.create_all()
+
+    def _sqlite_backup(self, source=None):
+        ''' copy the database to source (or source to the database) with the SQLite backup API '''
+        if self.engine.dialect.name != 'sqlite':
+            raise ValueError('Snapshots are only supported for SQLite, not %s'
+                             % self.engine.dialect.name)
+        self.session.remove()
+        raw = self.engine.raw_connection()
+        try:
+            if source is None:
+                target = sqlite3.connect(':memory:', check_same_thread=False)
+                raw.connection.backup(target)
+                return target
+            source.backup(raw.connection)
+        finally:
+            raw.close()
+
+    def snapshot(self):
+        ''' keep an in-memory copy of the (SQLite) database, e.g. after init() and fixtures '''
+        self._snapshot = self._sqlite_backup()
+
+    def restore(self):
+        ''' reset the database to the last snapshot, much faster than init() and fixtures '''
+        if self._snapshot is None:
+            raise RuntimeError('No snapshot to restore, call snapshot() first')
+        self._sqlite_backup(self._snapshot)
+
+    @contextmanager
+    def transaction(self):
+        ''' scope whose changes are rolled back at the end, even if they were committed
+
+        The session works within a savepoint, which is restarted after every commit or
+        rollback, so its own transaction is never committed and is rolled back at the end.
+
+        Returns:
+            the (scoped) session
+        '''
+        connection = self.engine.connect()
+        if connection.dialect.name == 'sqlite':
+            connection.execute('BEGIN')  # pysqlite only begins implicitly before DML
+        session = self.create_scoped_session(options=dict(bind=connection, binds={}))
+        session.begin_nested()
+
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        event.listen(session(), 'after_transaction_end', restart_savepoint)
+        self.session, session_before = session, self.session
+        try:
+            yield session
+        finally:
+            self.session = session_before
+            event.remove(session(), 'after_transaction_end', restart_savepoint)
+            session.remove()
+            connection.close()
+
+    def identity_map_size(self):
+        ''' number of objects currently tracked by the session '''
+        return len(self.session.identity_map)
+
+    @contextmanager
+    def worker_session(self, max_objects=0):
+        ''' scope for long-running workers that keeps the session small
+
+        Because expire_on_commit is disabled, the session holds on to every object
+        it has seen. Within this scope the identity map is pruned after each commit.
+
+        Args:
+            max_objects (int): only prune when more than this many objects are tracked
+        Returns:
+            the (scoped) session
+        '''
+        session = self.session()
+
+        def prune(session):
+            if len(session.identity_map) > max_objects:
+                session.expunge_all()
+
+        event.listen(session, 'after_commit', prune)
+        try:
+            yield session
+        finally:
+            event.remove(session, 'after_commit', prune)
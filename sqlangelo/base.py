@@ -1,4 +1,9 @@
-from .mixins import CRUD, Naming, inflect_engine
+from sqlalchemy import event, exists, inspect, select
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from .hierarchy import Hierarchy, maintain_closure
+from .mixins import CRUD, Naming, Operations, inflect_engine
+from .profiling import operation
 
 
 def log(msg):
@@ -8,7 +13,7 @@ def log(msg):
 
 def get_base_model(db):  # noqa: C901
 
-    class BaseModel(db.Model, CRUD, Naming):
+    class BaseModel(db.Model, CRUD, Operations, Naming):
         """ used as super model for all other models
 
         :var id: every model should have a unique id
@@ -16,6 +21,7 @@ def get_base_model(db):  # noqa: C901
         __abstract__ = True
 
         id = db.Column(db.Integer, primary_key=True)
+        hierarchies = {}  # name of self-referential cross reference -> Hierarchy
 
         @classmethod
         def make_polymorphic_top(basemodel, cls, identities):
@@ -69,12 +75,70 @@ def get_base_model(db):  # noqa: C901
                                                remote_side=peer_cls.id,
                                                **kwargs))
 
+        @classmethod
+        def _add_counter_cache(cls, peer_cls, foreign_key, name):
+            """ keep a count of referring objects in peer_cls.<name> """
+            log('   counter cache: %s.%s' % (peer_cls.__name__, name))
+            setattr(peer_cls, name, db.Column(db.Integer, default=0, server_default='0',
+                                              nullable=False))
+            cls.counter_caches = tuple(cls.counter_caches) + ((foreign_key, peer_cls, name),)
+            peer_table = peer_cls.__table__
+
+            def change(target, connection, peer_id, delta):
+                if peer_id is None:
+                    return
+                connection.execute(peer_table.update()
+                                   .where(peer_table.c.id == peer_id)
+                                   .values({name: peer_table.c[name] + delta}))
+                # keep a loaded peer in sync (sessions don't expire on commit)
+                peer = object_session(target).identity_map.get(
+                    inspect(peer_cls).identity_key_from_primary_key([peer_id]))
+                if peer is not None and name in peer.__dict__:
+                    set_committed_value(peer, name, peer.__dict__[name] + delta)
+
+            def stored(connection, target, history):
+                """ foreign key before this flush (also when expired, e.g. after a rollback) """
+                if history.deleted:
+                    return history.deleted[0]
+                if history.unchanged:
+                    return history.unchanged[0]
+                fk_column = cls.__table__.c[foreign_key]
+                return connection.execute(select([fk_column])
+                                          .where(cls.__table__.c.id == target.id)).scalar()
+
+            @event.listens_for(cls, 'after_insert', propagate=True)
+            def increment(mapper, connection, target):
+                change(target, connection, getattr(target, foreign_key), 1)
+
+            @event.listens_for(cls, 'before_delete', propagate=True)
+            def decrement(mapper, connection, target):
+                history = inspect(target).attrs[foreign_key].history
+                change(target, connection, stored(connection, target, history), -1)
+
+            @event.listens_for(cls, 'before_update', propagate=True)
+            def move(mapper, connection, target):
+                history = inspect(target).attrs[foreign_key].history
+                if history.added:
+                    old = stored(connection, target, history)
+                    if old != history.added[0]:
+                        change(target, connection, old, -1)
+                        change(target, connection, history.added[0], 1)
+
         @classmethod
         def add_reference(cls, peer_cls, name=None, rev_name='', nullable=False, default=None,
-                          rev_cascade='save-update, merge, delete', add_backref=True):
-            """ create 1:n relation """
+                          rev_cascade='save-update, merge, delete', add_backref=True,
+                          counter_cache=False):
+            """ create 1:n relation
+
+            If counter_cache is set, peer_cls gets a column (<rev_name>_count by default,
+            or the name given) that counts the objects referring to it.
+            """
             name = name or peer_cls.__tablename__
             foreign_key = cls._add_foreign_key(peer_cls, name, nullable, default)
+            if counter_cache:
+                if counter_cache is True:
+                    counter_cache = '%s_count' % (rev_name or cls.get_plural())
+                cls._add_counter_cache(peer_cls, foreign_key, counter_cache)
 
             # prepare optional relation kwarg
             kwargs = dict()
@@ -103,8 +167,14 @@ def get_base_model(db):  # noqa: C901
                 cls._add_relationship(peer_cls, name, foreign_key, **kwargs)
 
         @classmethod
-        def add_cross_reference(cls, peer_cls, names=None, x_names=None, x_cls=None):
-            """ adds an m:n relation between this class and peer_cls """
+        def add_cross_reference(cls, peer_cls, names=None, x_names=None, x_cls=None,
+                                closure=False):
+            """ adds an m:n relation between this class and peer_cls
+
+            A self-referential relation can be traversed with descendants, ancestors and
+            path_exists. If closure is True, these read a closure table that is maintained
+            on every change, instead of running a recursive query.
+            """
             names = names or (cls.__tablename__, peer_cls.__tablename__)
             x_names = x_names or (inflect_engine.plural(names[1]), inflect_engine.plural(names[0]))
 
@@ -135,9 +205,89 @@ def get_base_model(db):  # noqa: C901
                         secondary=x_cls.__tablename__,
                         backref=db.backref(x_names[1], lazy='dynamic'),
                         **kwargs))
+            if cls == peer_cls:
+                cls._add_hierarchy(x_cls, names, x_names, closure)
 
             return x_cls
 
+        @classmethod
+        def _add_hierarchy(cls, x_cls, names, x_names, closure):
+            columns = x_cls.__table__.c
+            hierarchy = Hierarchy(x_cls, columns['%s_id' % names[0]], columns['%s_id' % names[1]],
+                                  None)
+            # the recursive queries walk the edges both ways
+            db.Index('ix_%s_source' % x_cls.__tablename__, hierarchy.source, hierarchy.target)
+            db.Index('ix_%s_target' % x_cls.__tablename__, hierarchy.target, hierarchy.source)
+            if closure:
+                closure_cls = type('%s%sClosure' % (cls.__name__, x_names[0].capitalize()),
+                                   (db.BaseModel,),
+                                   dict(depth=db.Column(db.Integer, nullable=False)))
+                closure_cls.add_reference(cls, name='ancestor', add_backref=False)
+                closure_cls.add_reference(cls, name='descendant', add_backref=False)
+                log('   closure table: %s' % closure_cls.__tablename__)
+                table = closure_cls.__table__
+                db.Index('ix_%s_ancestor' % table.name, table.c.ancestor_id, table.c.depth)
+                db.Index('ix_%s_descendant' % table.name, table.c.descendant_id, table.c.depth)
+                hierarchy = hierarchy._replace(closure=table)
+                maintain_closure(db, cls, x_names, hierarchy)
+                cls.closures = tuple(cls.closures) + (hierarchy,)
+            cls.hierarchies = dict(cls.hierarchies, **{x_names[0]: hierarchy})
+
+        @classmethod
+        def _get_hierarchy(cls, relation):
+            if relation is None:
+                if len(cls.hierarchies) != 1:
+                    raise ValueError('%s has %d self-referential cross references, specify one'
+                                     % (cls.__name__, len(cls.hierarchies)))
+                relation = next(iter(cls.hierarchies))
+            return cls.hierarchies[relation]
+
+        @classmethod
+        @operation
+        def descendants(cls, node, relation=None, max_depth=None):
+            """ query all objects reachable from node through a self-referential cross reference
+
+            Args:
+                node (object or int): object (or its id) to start from (not included)
+                relation (string): name of the cross reference (needed if there are several)
+                max_depth (int): maximum number of steps (unlimited by default)
+            Returns:
+                query
+            """
+            node_id = getattr(node, 'id', node)
+            ids = cls._get_hierarchy(relation).reachable(node_id, max_depth=max_depth)
+            return cls.query.filter(cls.id.in_(ids), cls.id != node_id)
+
+        @classmethod
+        @operation
+        def ancestors(cls, node, relation=None, max_depth=None):
+            """ query all objects from which node is reachable (see descendants) """
+            node_id = getattr(node, 'id', node)
+            ids = cls._get_hierarchy(relation).reachable(node_id, up=True, max_depth=max_depth)
+            return cls.query.filter(cls.id.in_(ids), cls.id != node_id)
+
+        @classmethod
+        @operation
+        def path_exists(cls, start, end, relation=None, max_depth=None):
+            """ return True if end is a descendant of start (see descendants)
+
+            Like descendants, a node is never its own descendant, even on a cycle.
+            """
+            end_id = getattr(end, 'id', end)
+            if end_id == getattr(start, 'id', start):
+                return False
+            ids = cls._get_hierarchy(relation).reachable(getattr(start, 'id', start),
+                                                         max_depth=max_depth).alias()
+            return db.session.query(exists().where(list(ids.c)[0] == end_id)).scalar()
+
+        @classmethod
+        @operation
+        def rebuild_closure(cls, relation=None, commit=True):
+            """ recompute the closure table, e.g. after enabling it for existing data """
+            cls._get_hierarchy(relation).rebuild(db.session.connection(), cls.__table__)
+            if commit:
+                db.session.commit()
+
         @classmethod
         def add_enum_reference(cls, peer_cls, **kwargs):
             kwargs.setdefault('nullable', True)
@@ -0,0 +1,165 @@
+""" Write-behind queue that coalesces creates into bulk inserts """
+from collections import OrderedDict
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+import atexit
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+STOP = object()  # queued by close() to stop the writer thread
+
+
+class BufferedWriter(object):
+    """ inserts queued records from a background thread in chunked bulk inserts
+
+    A batch is written when it holds batch_size records or flush_interval seconds after
+    its first record arrived. Records bypass CRUD.create, so before/after_create hooks
+    and ORM events do not run (counter caches are recounted and closure rows added per batch).
+
+    Args:
+        db (SQLAngelo): database
+        batch_size (int): maximum number of records per insert
+        flush_interval (float): maximum seconds a record waits in a partial batch
+        max_queue (int): maximum number of queued records; put blocks when full
+        on_error (callable): called with the failed records (list of (model, dict)) and the
+            exception (failed batches are always logged)
+    Raises:
+        ValueError: if the engine shares one connection between threads (e.g. in-memory
+            SQLite), as the writer would then commit the other threads' changes
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_queue=10000, on_error=None):
+        if isinstance(db.engine.pool, (StaticPool, SingletonThreadPool)):
+            raise ValueError('The buffered writer needs its own connection, which %s does not '
+                             'provide' % type(db.engine.pool).__name__)
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.queue = queue.Queue(max_queue)
+        self.closed = False
+        self.putting = 0  # puts in progress, close() waits for them before queueing STOP
+        self.condition = threading.Condition()
+        self.written = self.failed = self.batches = 0
+        self.last_latency = self.max_latency = 0.0
+        self.thread = threading.Thread(target=self._run, name='sqlangelo-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, cls, values, timeout=None):
+        """ queue a record
+
+        Args:
+            cls (model): model to create
+            values (dict): column values
+            timeout (float): seconds to wait for room in the queue (forever by default)
+        Raises:
+            queue.Full: if the queue is still full after timeout
+        """
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Writer is closed')
+            self.putting += 1
+        try:
+            self.queue.put((cls, values), timeout=timeout)
+        finally:
+            with self.condition:
+                self.putting -= 1
+                self.condition.notify_all()
+
+    def flush(self):
+        """ wait until all records queued so far have been written (or failed) """
+        self.queue.join()
+
+    def close(self, timeout=None):
+        """ write the remaining records and stop the writer thread """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            while self.putting:  # so STOP is the last item in the queue
+                self.condition.wait()
+        atexit.unregister(self.close)
+        self.queue.put(STOP)
+        self.thread.join(timeout)
+
+    def stats(self):
+        """ return dict with queue depth, record and batch counts and flush latency (seconds) """
+        return dict(queue_depth=self.queue.qsize(),
+                    written=self.written,
+                    failed=self.failed,
+                    batches=self.batches,
+                    last_latency=self.last_latency,
+                    max_latency=self.max_latency)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+                deadline = deadline or time.time() + self.flush_interval
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        start = time.time()
+        by_model = OrderedDict()
+        for cls, values in batch:
+            by_model.setdefault(cls, []).append(values)
+        session = None
+        try:
+            session = Session(bind=self.db.engine)
+            for cls, records in by_model.items():
+                self._insert(session, cls, records)
+            session.commit()
+            self.written += len(batch)
+        except Exception as e:
+            if session is not None:
+                session.rollback()
+            self.failed += len(batch)
+            logger.exception('Failed to write %d buffered records', len(batch))
+            if self.on_error:
+                try:
+                    self.on_error(batch, e)
+                except Exception:
+                    logger.exception('Error callback failed')
+        finally:
+            if session is not None:
+                session.close()
+            self.batches += 1
+            self.last_latency = time.time() - start
+            self.max_latency = max(self.max_latency, self.last_latency)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _insert(self, session, cls, records):
+        mapper = inspect(cls)
+        if mapper.polymorphic_on is not None:  # bulk inserts leave this to us
+            identity = mapper.get_property_by_column(mapper.polymorphic_on).key
+            for rec in records:
+                rec.setdefault(identity, mapper.polymorphic_identity)
+        # multi-table (joined inheritance) models need each primary key for the next table,
+        # closure tables the ids of the new nodes
+        session.bulk_insert_mappings(cls, records,
+                                     return_defaults=len(mapper.tables) > 1 or bool(cls.closures))
+        for hierarchy in cls.closures:
+            hierarchy.add_nodes(session.connection(), [rec['id'] for rec in records])
+        for foreign_key, peer_cls, name in cls.counter_caches:
+            ids = {rec.get(foreign_key) for rec in records} - {None}
+            cls._recount(foreign_key, peer_cls, name, ids, session=session)
@@ -38,6 +38,8 @@ def add_reference(peer_cls, **kwargs):
             * default (int): default value of foreign key
             * rev_cascade (string): cascade directive for back reference ('save-update, merge, delete' by default)
             * add_backref: if True add a back reference to peer_cls
+            * counter_cache (boolean or string): if set, add a column to peer_cls that counts
+              references (named <rev_name>_count by default)
     """
     def class_decorator(cls):
         cls.add_reference(peer_cls, **kwargs)
@@ -77,6 +79,7 @@ def add_cross_reference(peer_cls=None, **kwargs):
         names (tuple of strings): names for reference from class to peer_cls and vice versa
         x_cls (model): model to hold references to class and peer_cls (if None, a new model is defined and named after class and peer_cls)
         x_names (tuple of strings): names for references from x_cls to class and peer_cls
+        closure (boolean): for a self-reference, maintain a closure table for fast traversal
     """
     def class_decorator(cls):
         cls.add_cross_reference(peer_cls or cls, **kwargs)
@@ -0,0 +1,182 @@
+""" Traversal of self-referential cross references, with an optional closure table """
+from collections import namedtuple
+from sqlalchemy import bindparam, distinct, event, func, literal, select
+from sqlalchemy.orm import attributes
+
+
+class Hierarchy(namedtuple('Hierarchy', 'model source target closure')):
+    """ edges from the source to the target column of a cross reference model
+
+    closure is the table with (ancestor_id, descendant_id, depth) for every pair of
+    connected nodes (depth is the shortest distance), or None.
+    """
+
+    def reachable(self, start_id, up=False, max_depth=None):
+        """ select the ids of nodes reachable from start_id
+
+        Args:
+            start_id (int): id of node to start from
+            up (boolean): follow edges from target to source (ancestors)
+            max_depth (int): maximum number of edges to follow (unlimited by default)
+        """
+        if self.closure is not None:
+            c = self.closure.c
+            start, end = (c.descendant_id, c.ancestor_id) if up \
+                else (c.ancestor_id, c.descendant_id)
+            query = select([end]).where(start == start_id).where(c.depth > 0)
+            if max_depth is not None:
+                query = query.where(c.depth <= max_depth)
+            return query
+
+        source, target = (self.target, self.source) if up else (self.source, self.target)
+        if max_depth is None:  # no depth column, so UNION also ends cycles
+            cte = select([target.label('id')]).where(source == start_id).cte(recursive=True)
+            cte = cte.union(select([target]).where(source == cte.c.id))
+        else:
+            cte = select([target.label('id'), literal(1).label('depth')]) \
+                .where(source == start_id).cte(recursive=True)
+            cte = cte.union(select([target, cte.c.depth + 1])
+                            .where(source == cte.c.id)
+                            .where(cte.c.depth < max_depth))
+        return select([cte.c.id])
+
+    def add_nodes(self, connection, node_ids):
+        """ add the closure rows of new nodes (to themselves) """
+        connection.execute(self.closure.insert(), [
+            dict(ancestor_id=node_id, descendant_id=node_id, depth=0) for node_id in node_ids])
+
+    def subtree(self, connection, node_id):
+        """ return the ids of node_id and its descendants """
+        return {node_id} | {row[0] for row in connection.execute(self.reachable(node_id))}
+
+    def link(self, connection, parent_id, child_id):
+        """ add the closure rows of a new edge: ancestors(parent) x descendants(child) """
+        c = self.closure.c
+        above = dict(connection.execute(select([c.ancestor_id, c.depth])
+                                        .where(c.descendant_id == parent_id)).fetchall())
+        below = dict(connection.execute(select([c.descendant_id, c.depth])
+                                        .where(c.ancestor_id == child_id)).fetchall())
+        existing = {(ancestor, descendant): depth
+                    for ancestor, descendant, depth in connection.execute(
+                        select([c.ancestor_id, c.descendant_id, c.depth])
+                        .where(c.ancestor_id.in_(above))
+                        .where(c.descendant_id.in_(below)))}
+        new, shorter = [], []
+        for ancestor, up in above.items():
+            for descendant, down in below.items():
+                depth = up + down + 1
+                old = existing.get((ancestor, descendant))
+                if old is None:
+                    new.append(dict(ancestor_id=ancestor, descendant_id=descendant, depth=depth))
+                elif depth < old:
+                    shorter.append(dict(a=ancestor, d=descendant, new_depth=depth))
+        if new:
+            connection.execute(self.closure.insert(), new)
+        if shorter:
+            connection.execute(self.closure.update()
+                               .where(c.ancestor_id == bindparam('a'))
+                               .where(c.descendant_id == bindparam('d'))
+                               .values(depth=bindparam('new_depth')), shorter)
+
+    def refresh(self, connection, node_ids, max_depth=None):
+        """ recompute the closure rows of node_ids from the edges, e.g. after removing some
+
+        A recursive query walks the edges up from node_ids, so only their ancestors are read.
+
+        Args:
+            node_ids (iterable): ids of the nodes whose ancestors changed (their rows to
+                themselves are kept)
+            max_depth (int): longest possible path (by default the number of ancestors
+                node_ids had before, which is enough when edges were only removed)
+        """
+        node_ids = list(node_ids)
+        if not node_ids:
+            return
+        c = self.closure.c
+        if max_depth is None:
+            max_depth = connection.execute(select([func.count(distinct(c.ancestor_id))])
+                                           .where(c.descendant_id.in_(node_ids))).scalar()
+        up = select([self.target.label('node_id'), self.source.label('ancestor_id'),
+                     literal(1).label('depth')]) \
+            .where(self.target.in_(node_ids)).cte(recursive=True)
+        up = up.union(select([up.c.node_id, self.source, up.c.depth + 1])
+                      .where(self.target == up.c.ancestor_id)
+                      .where(up.c.depth < max_depth))
+        shortest = select([up.c.ancestor_id, up.c.node_id, func.min(up.c.depth)]) \
+            .where(up.c.ancestor_id != up.c.node_id) \
+            .group_by(up.c.ancestor_id, up.c.node_id)
+        connection.execute(self.closure.delete()
+                           .where(c.descendant_id.in_(node_ids))
+                           .where(c.ancestor_id != c.descendant_id))
+        connection.execute(self.closure.insert()
+                           .from_select(['ancestor_id', 'descendant_id', 'depth'], shortest))
+
+    def rebuild(self, connection, node_table):
+        """ recompute the whole closure table, e.g. for existing data """
+        node_ids = [row[0] for row in connection.execute(select([node_table.c.id]))]
+        connection.execute(self.closure.delete())
+        if node_ids:
+            self.add_nodes(connection, node_ids)
+        self.refresh(connection, node_ids, max_depth=len(node_ids))
+
+
+def changed_edges(session, cls, relations):
+    """ return the edges (parent, child) added and the children of edges removed by a flush """
+    added, removed = set(), set()
+    for obj in session.new | session.dirty:
+        if isinstance(obj, cls):
+            forward, backward = [
+                attributes.get_history(obj, name, attributes.PASSIVE_NO_INITIALIZE)
+                for name in relations]
+            added.update((obj.id, child.id) for child in forward.added)
+            added.update((parent.id, obj.id) for parent in backward.added)
+            removed.update(child.id for child in forward.deleted)
+            if backward.deleted:
+                removed.add(obj.id)
+    return added, removed
+
+
+def maintain_closure(db, cls, relations, hierarchy):
+    """ keep the closure table of hierarchy in sync with changes to the edges
+
+    Edges change through the relationships (relations: forward and back reference names)
+    or through the association model itself.
+    """
+    closure = hierarchy.closure
+    source_key, target_key = hierarchy.source.name, hierarchy.target.name
+
+    @event.listens_for(cls, 'after_insert', propagate=True)
+    def add_node(mapper, connection, target):
+        hierarchy.add_nodes(connection, [target.id])
+
+    @event.listens_for(cls, 'before_delete', propagate=True)
+    def remove_node(mapper, connection, target):
+        subtree = hierarchy.subtree(connection, target.id) - {target.id}
+        connection.execute(closure.delete().where((closure.c.ancestor_id == target.id) |
+                                                  (closure.c.descendant_id == target.id)))
+        attributes.instance_state(target).info['closure_subtree'] = subtree
+
+    @event.listens_for(cls, 'after_delete', propagate=True)
+    def refresh_subtree(mapper, connection, target):
+        subtree = attributes.instance_state(target).info.pop('closure_subtree')
+        hierarchy.refresh(connection, subtree)
+
+    @event.listens_for(hierarchy.model, 'after_insert')
+    def add_edge(mapper, connection, target):
+        hierarchy.link(connection, getattr(target, source_key), getattr(target, target_key))
+
+    @event.listens_for(hierarchy.model, 'after_delete')
+    def remove_edge(mapper, connection, target):
+        hierarchy.refresh(connection, hierarchy.subtree(connection, getattr(target, target_key)))
+
+    def change_relationships(session, flush_context):
+        added, removed = changed_edges(session, cls, relations)
+        if added or removed:
+            connection = session.connection()
+            if removed:  # recomputed from the edges, which include the added ones
+                subtrees = [hierarchy.subtree(connection, child) for child in removed]
+                hierarchy.refresh(connection, set().union(*subtrees))
+            for parent_id, child_id in added:
+                hierarchy.link(connection, parent_id, child_id)
+
+    db.listen_session('after_flush', change_relationships)
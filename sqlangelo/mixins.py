@@ -1,8 +1,12 @@
 from pprint import pformat
+from sqlalchemy import func, literal_column, select
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm.interfaces import MANYTOMANY, ONETOMANY
 import inflect
+from .profiling import operation
 
 inflect_engine = inflect.engine()
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')  # functions supported by Operations.aggregate
 
 
 class Naming(object):
@@ -80,6 +84,8 @@ class CRUD(object):
     Available as app.db.CRUDmixin.
     """
     delay_save = False  # only commit when explicitely instructed
+    counter_caches = ()  # (foreign key, peer model, count column) as added by add_reference
+    closures = ()  # hierarchies with a closure table, as added by add_cross_reference
 
     @classmethod
     def report(cls, msg):
@@ -95,6 +101,7 @@ class CRUD(object):
             del kwargs[r]
 
     @classmethod
+    @operation
     def create(cls, commit=True, report=True, **kwargs):
         """ create an object of this class
 
@@ -118,6 +125,30 @@ class CRUD(object):
         obj.after_create(kwargs)
         return obj
 
+    @classmethod
+    def create_async_buffered(cls, timeout=None, **kwargs):
+        """ queue an object for creation by the database's write-behind writer
+
+        Unlike create, nothing is returned and before_create/after_create are not called.
+        References to other objects are stored by id.
+
+        Args:
+            timeout (float): seconds to wait when the queue is full (forever by default)
+            kwargs: keyword arguments to be used as column values after cleaning
+        Raises:
+            ValueError: if a referenced object has no id yet (flush or commit it first)
+        """
+        cls.__clean_kwargs(kwargs)
+        for key, value in list(kwargs.items()):
+            if isinstance(value, CRUD):
+                if value.id is None:
+                    raise ValueError('%s has no id yet, commit it before referring to it'
+                                     % type(value).__name__)
+                del kwargs[key]
+                kwargs['%s_id' % key] = value.id
+        cls.db.writer().put(cls, kwargs, timeout)
+
+    @operation
     def update(self, commit=True, report=True, **kwargs):
         """ update an object
 
@@ -151,10 +182,12 @@ class CRUD(object):
         Returns:
             object
         """
+        self.db.session.add(self)  # re-attach, e.g. after a worker_session pruned it
         if really and not self.delay_save:
             self.db.session.commit()
         return self
 
+    @operation
     def delete(self, commit=True, report=True):
         """ delete an object
 
@@ -169,6 +202,7 @@ class CRUD(object):
         """
         if report:
             self.report('Deleting %s "%s"' % (self.__class__.__name__, self))
+        self.db.session.add(self)
         self.db.session.delete(self)
         self.after_delete()
         return commit and self.db.session.commit()
@@ -194,6 +228,7 @@ class CRUD(object):
         pass
 
     @classmethod
+    @operation
     def bulk_insert(cls, new_records):
         """ efficiently create a batch of objects
         Args:
@@ -202,20 +237,59 @@ class CRUD(object):
         print('Bulk insert of %s: %s' % (cls.__name__, new_records))
         max_id = cls.get_max_id()
         for rec in new_records:
-            if id not in rec:
+            if 'id' not in rec:
                 max_id += 1
                 rec['id'] = max_id
         cls.db.engine.execute(cls.__table__.insert(), new_records)
         cls.commit()
+        if cls.counter_caches or cls.closures:
+            for hierarchy in cls.closures:
+                hierarchy.add_nodes(cls.db.session.connection(),
+                                    [rec['id'] for rec in new_records])
+            for foreign_key, peer_cls, name in cls.counter_caches:
+                ids = {rec.get(foreign_key) for rec in new_records} - {None}
+                cls._recount(foreign_key, peer_cls, name, ids)
+            cls.db.session.commit()
+
+    @classmethod
+    def _recount(cls, foreign_key, peer_cls, name, ids=None, session=None):
+        session = session or cls.db.session
+        peer_table = peer_cls.__table__
+        count = select([func.count()]).where(
+            cls.__table__.c[foreign_key] == peer_table.c.id).as_scalar()
+        stmt = peer_table.update().values({name: count})
+        if ids is not None:
+            stmt = stmt.where(peer_table.c.id.in_(ids))
+        session.execute(stmt)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, peer_cls):
+                session.expire(obj, [name])
+
+    @classmethod
+    @operation
+    def recount(cls, commit=True):
+        """ recompute the counter caches of references from this class
+
+        Use this to repair counts after bypassing the ORM (e.g. Query.delete).
+
+        Args:
+            commit (boolean): write to database
+        """
+        for counter in cls.counter_caches:
+            cls._recount(*counter)
+        if commit:
+            cls.db.session.commit()
 
 
 class Operations(object):
 
     @classmethod
+    @operation
     def get(cls, id):
         return cls.db.session.query(cls).get(id)
 
     @classmethod
+    @operation
     def get_by(cls, key, val, one=True, or_none=True):
         rec = cls.db.session.query(cls).filter(getattr(cls, key) == val)
         if one:
@@ -227,6 +301,7 @@ class Operations(object):
             return rec.all()
 
     @classmethod
+    @operation
     def get_or_404(cls, id):
         return cls.db.session.query(cls).get_or_404(id)
 
@@ -237,14 +312,85 @@ class Operations(object):
         return obj
 
     @classmethod
+    @operation
     def get_max_id(cls):
         return cls.db.session.query(cls.db.func.max(cls.id)).scalar() or 0
 
     @classmethod
+    @operation
+    def aggregate(cls, *criteria, **aggregates):
+        """ compute aggregates in the database instead of on loaded objects
+
+        >>> Employee.aggregate(count='*', sum='salary', group_by='company_id')  # doctest: +SKIP
+        {1: {'count': 2, 'sum': Decimal('7500.00')}}
+        >>> Employee.aggregate(low=('min', 'salary'), high=('max', 'salary'))  # doctest: +SKIP
+        {'low': Decimal('2500.00'), 'high': Decimal('5000.00')}
+
+        Args:
+            criteria: filter expressions
+            aggregates: keyword arguments
+
+                * group_by (string): name of column to group by
+                * any of AGGREGATES: name of column to aggregate ('*' for all rows)
+                * any other: (function, column name) pair, to label the result
+        Returns:
+            dict of aggregate values (or a dict of those keyed by the group_by value)
+        Raises:
+            ValueError: for functions not in AGGREGATES
+        """
+        group_by = aggregates.pop('group_by', None)
+        names = sorted(aggregates)
+        funcs = []
+        for name in names:
+            function, column = aggregates[name] if isinstance(aggregates[name], tuple) \
+                else (name, aggregates[name])
+            if function not in AGGREGATES:
+                raise ValueError('Unknown aggregate %s, use one of %s'
+                                 % (function, ', '.join(AGGREGATES)))
+            funcs.append(getattr(func, function)(
+                literal_column('*') if column == '*' else getattr(cls, column)))
+        if group_by is None:
+            row = cls.db.session.query(*funcs).select_from(cls).filter(*criteria).one()
+            return dict(zip(names, row))
+        key = getattr(cls, group_by)
+        rows = cls.db.session.query(key, *funcs).select_from(cls).filter(*criteria).group_by(key)
+        return {row[0]: dict(zip(names, row[1:])) for row in rows}
+
+    @classmethod
+    @operation
+    def count_by(cls, relationship, ids=None):
+        """ count related objects for many parents in a single query
+
+        Works for 1:n and m:n relationships, including dynamic back references,
+        e.g. Company.count_by('employees').
+
+        Args:
+            relationship (string): name of a relationship of this model
+            ids (list of ints): only count for these parents (default: all having related objects)
+        Returns:
+            dict of parent id to count (0 for requested ids without related objects)
+        """
+        prop = inspect(cls).relationships[relationship]
+        if prop.direction not in (ONETOMANY, MANYTOMANY):
+            raise ValueError('%s.%s does not refer to many objects' % (cls.__name__, relationship))
+        key = prop.synchronize_pairs[0][1]  # foreign key on the peer or association table
+        query = cls.db.session.query(key, func.count())
+        if prop.secondary is None:
+            query = query.select_from(prop.mapper)
+        query = query.group_by(key)
+        if ids is None:
+            return dict(query)
+        counts = dict.fromkeys(ids, 0)
+        counts.update(query.filter(key.in_(ids)))
+        return counts
+
+    @classmethod
+    @operation
     def commit(cls):
-        log('DIRTY: %s' % cls.db.session.dirty)
-        log('NEW: %s' % cls.db.session.new)
-        log('DELETED: %s' % cls.db.session.deleted)
+        from . import base
+        base.log('DIRTY: %s' % cls.db.session.dirty)
+        base.log('NEW: %s' % cls.db.session.new)
+        base.log('DELETED: %s' % cls.db.session.deleted)
         cls.db.session.commit()
 
     @classmethod
@@ -0,0 +1,137 @@
+""" Statement timing per model and SQLAngelo operation, with a slow-query log """
+from collections import deque
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.sql.util import find_tables
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+_context = threading.local()
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def operation(method):
+    """ decorator that attributes the statements issued by method to its model
+
+    Nested operations (e.g. create calling commit) are attributed to the outermost one.
+    """
+    @wraps(method)
+    def wrapper(obj, *args, **kwargs):
+        model = obj if isinstance(obj, type) else type(obj)
+        stack = _context.__dict__.setdefault('stack', [])
+        stack.append((model.__name__, method.__name__))
+        try:
+            return method(obj, *args, **kwargs)
+        finally:
+            stack.pop()
+    return wrapper
+
+
+def percentile(values, fraction):
+    """ nearest-rank percentile of sorted values """
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class Profiler(object):
+    """ times every statement of an engine
+
+    Statements issued outside a SQLAngelo operation (e.g. dynamic back references or
+    polymorphic queries) are attributed to the model of their first table as 'query'.
+
+    Args:
+        db (SQLAngelo): database, to map tables to models
+        threshold (float): log statements that take longer (in seconds) with their query plan
+        sample_size (int): number of recent timings per model and operation kept for the
+            percentiles, so memory stays bounded however long the process runs
+    """
+
+    def __init__(self, db, threshold=None, sample_size=1000):
+        self.db = db
+        self.threshold = threshold
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        self.tables = {}  # table -> model name
+        self.registry_size = 0
+        self.reset()
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}  # (model, operation) -> [count, max, affected rows, recent seconds]
+
+    def stats(self):
+        """ return dict of (model, operation) to count, p50, p95, max (seconds) and affected_rows
+
+        count, max and affected_rows cover all statements, the percentiles the most recent
+        sample_size. affected_rows counts rows inserted, updated or deleted, as reported by
+        the driver; rows returned by SELECTs are not counted (most drivers don't know them
+        up front).
+        """
+        with self.lock:
+            timings = {key: (count, slowest, rows, sorted(recent))
+                       for key, [count, slowest, rows, recent] in self.timings.items()}
+        return {key: dict(count=count,
+                          p50=percentile(recent, 0.5),
+                          p95=percentile(recent, 0.95),
+                          max=slowest,
+                          affected_rows=rows)
+                for key, (count, slowest, rows, recent) in timings.items()}
+
+    def attribute(self, context):
+        """ return (model, operation) for the statement being executed """
+        stack = getattr(_context, 'stack', None)
+        if stack:
+            return stack[0]
+        compiled = getattr(context, 'compiled', None)
+        if compiled is not None:
+            registry = self.db.Model._decl_class_registry
+            if len(registry) != self.registry_size:
+                self.registry_size = len(registry)
+                self.tables = {model.__table__: model.__name__ for model in registry.values()
+                               if hasattr(model, '__table__')}
+            # the top-level FROM first, rather than e.g. a subquery on an association table
+            froms = getattr(compiled.statement, 'froms', [])
+            for table in froms + find_tables(compiled.statement, include_crud=True):
+                if table in self.tables:
+                    return self.tables[table], 'query'
+        return None, 'query'
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('sqlangelo_start', []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.time() - conn.info['sqlangelo_start'].pop()
+        key = self.attribute(context)
+        rows = max(cursor.rowcount, 0)  # -1 when unknown, e.g. for SELECTs
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = [0, 0.0, 0, deque(maxlen=self.sample_size)]
+            timing[0] += 1
+            timing[1] = max(timing[1], seconds)
+            timing[2] += rows
+            timing[3].append(seconds)
+        if self.threshold is not None and seconds >= self.threshold:
+            plan = self.explain(conn, statement, parameters[0] if executemany else parameters)
+            logger.warning('Slow query (%.3fs) in %s.%s: %s\n%s',
+                           seconds, key[0], key[1], statement, plan)
+
+    def explain(self, conn, statement, parameters):
+        """ return the query plan of statement """
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return ''
+        prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+        except Exception as e:
+            return 'EXPLAIN failed: %s' % e
+        finally:
+            cursor.close()
@@ -0,0 +1,60 @@
+""" pytest fixtures for a fast database reset between tests
+
+Usage in conftest.py::
+
+    from sqlangelo.testing import make_fixtures
+    from myapp import db, fixtures
+
+    db_schema, db_snapshot, db_transaction = make_fixtures(db, fixtures.load)
+"""
+from sqlalchemy import event
+import pytest
+
+
+def make_fixtures(db, seed=None):
+    """ create fixtures that build the database once and reset it per test
+
+    Args:
+        db (SQLAngelo): database
+        seed (callable): fills the freshly created database
+    Returns:
+        tuple of fixtures:
+
+            * db_schema: (session scope) creates, seeds and snapshots the database once
+            * db_snapshot: restores the snapshot before and after the test
+            * db_transaction: rolls back everything the test does (also when committed);
+              cheaper than db_snapshot, as it only restores the snapshot when something
+              was committed since the last reset (e.g. by tests without these fixtures)
+    """
+    state = dict(dirty=False)  # committed since the last reset
+
+    def committed(connection):
+        state['dirty'] = True
+
+    def restore():
+        db.restore()
+        state['dirty'] = False
+
+    @pytest.fixture(scope='session')
+    def db_schema():
+        db.init()
+        if seed:
+            seed()
+        db.snapshot()
+        event.listen(db.engine, 'commit', committed)
+        return db
+
+    @pytest.fixture
+    def db_snapshot(db_schema):
+        restore()
+        yield db
+        restore()
+
+    @pytest.fixture
+    def db_transaction(db_schema):
+        if state['dirty']:
+            restore()
+        with db.transaction():
+            yield db
+
+    return db_schema, db_snapshot, db_transaction
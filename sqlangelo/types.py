@@ -1,3 +1,4 @@
+import decimal
 import sqlalchemy
 
 
@@ -17,3 +18,96 @@ class PercentageType(sqlalchemy.Numeric):
     def __init__(self, **kwargs):
         kwargs.setdefault('scale', 2)
         super(PercentageType, self).__init__(**kwargs)
+
+
+class ScaledIntegerType(sqlalchemy.types.TypeDecorator):
+    """ SQLAlchemy column type to store fixed-point values as scaled integers
+
+    Values are stored and loaded as plain ints in units of 10**-scale (e.g. cents),
+    so loading needs no Decimal conversion. Only ints are accepted on write, so a
+    Decimal amount is never silently mistaken for units: convert it with to_units.
+    Use from_units/sum_units to convert whole columns.
+    """
+
+    impl = sqlalchemy.Integer
+
+    def __init__(self, scale=2, *args, **kwargs):
+        self.scale = scale
+        sqlalchemy.types.TypeDecorator.__init__(self, *args, **kwargs)
+
+    def process_bind_param(self, value, dialect):
+        if value is None or (isinstance(value, int) and not isinstance(value, bool)):
+            return value
+        raise TypeError('%s expects an int in units of 10**-%d, not %r (see to_units)'
+                        % (self.__class__.__name__, self.scale, value))
+
+
+class FastMoneyType(ScaledIntegerType):
+    """ SQLAlchemy column type to store money values as cents """
+
+
+class FastPercentageType(ScaledIntegerType):
+    """ SQLAlchemy column type to store percentage values as basis points """
+
+
+def to_units(value, scale=2):
+    """ convert an amount to a scaled integer, e.g. Decimal('12.345') to 1235 cents
+
+    Args:
+        value (Decimal, float, int or string): amount, rounded half up to the nearest unit
+        scale (int): number of decimals
+    Returns:
+        int (None is preserved)
+    """
+    if value is None:
+        return None
+    return int((decimal.Decimal(str(value)) * 10 ** scale).to_integral_value(
+        decimal.ROUND_HALF_UP))
+
+
+def from_units(values, scale=2):
+    """ convert a column of scaled integers to Decimals
+
+    Args:
+        values (iterable of ints): e.g. cents as loaded from a FastMoneyType column
+        scale (int): number of decimals
+    Returns:
+        list of Decimals (None is preserved)
+    """
+    exp = decimal.Decimal(1).scaleb(-scale)
+    return [None if v is None else decimal.Decimal(v).scaleb(-scale).quantize(exp) for v in values]
+
+
+def sum_units(values, scale=2):
+    """ sum a column of scaled integers with integer arithmetic
+
+    Args:
+        values (iterable of ints): e.g. cents as loaded from a FastMoneyType column
+        scale (int): number of decimals
+    Returns:
+        Decimal total (None values are skipped)
+    """
+    total = sum(v for v in values if v is not None)
+    return decimal.Decimal(total).scaleb(-scale).quantize(decimal.Decimal(1).scaleb(-scale))
+
+
+def migrate_to_units(bind, column, scale=2):
+    """ rescale the data of an existing Numeric column to scaled integers
+
+    Only the data is converted: changing the column type itself is up to your
+    migration tool. Run this in the same migration, *before* the type change, on the
+    migration's connection (e.g. op.get_bind() in Alembic); nothing is committed here.
+    It is not idempotent: running it twice scales the values twice.
+
+    Args:
+        bind (Connection): connection (or session) to execute on
+        column (Column): column to convert, e.g. Employee.__table__.c.salary
+        scale (int): number of decimals
+    Returns:
+        number of rows converted
+    """
+    scaled = sqlalchemy.func.round(column * 10 ** scale)
+    result = bind.execute(column.table.update()
+                          .where(column.isnot(None))
+                          .values({column.name: sqlalchemy.cast(scaled, sqlalchemy.Integer)}))
+    return result.rowcount
@@ -0,0 +1,9 @@
+from sqlangelo.testing import make_fixtures
+from tests.models import db, Company
+
+
+def seed():
+    Company.create(name='Seed', report=False)
+
+
+db_schema, db_snapshot, db_transaction = make_fixtures(db, seed)
@@ -9,6 +9,7 @@ db = SQLAngelo(app, 'sqlite:///db.sqlite3', True)
 ########################################
 
 
+@decorators.add_cross_reference(names=('parent', 'child'), closure=True)
 class Group(db.BaseModel):
     abbr = db.Column(db.Unicode(6), nullable=False)
 
@@ -32,7 +33,7 @@ class Company(db.BaseModel):
         return '%s: %s' % (self.name, ', '.join([str(e) for e in self.employees]))
 
 
-@decorators.add_reference(Company)
+@decorators.add_reference(Company, counter_cache=True)
 @decorators.extend_model(User)
 class Employee(object):
-    salary = types.MoneyType()
+    salary = db.Column(types.MoneyType())
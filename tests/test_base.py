@@ -1,9 +1,145 @@
 from tests import models
+from unittest import mock
+import pytest
 import unittest
 
 
+@pytest.mark.usefixtures('db_snapshot')
 class TestBase(unittest.TestCase):
 
     def test_basemodel(self):
         self.assertTrue(models.BaseModel.__abstract__)
         self.assertTrue(hasattr(models.BaseModel, 'id'))
+
+    def test_counter_cache(self):
+        acme = models.Company.create(name='ACME', report=False)
+        other = models.Company.create(name='Other', report=False)
+        first = models.Employee.create(email='first', company=acme, report=False)
+        models.Employee.create(email='second', company=acme, report=False)
+        self.assertEqual((acme.employees_count, other.employees_count), (2, 0))
+
+        first.update(company=other, report=False)
+        self.assertEqual((acme.employees_count, other.employees_count), (1, 1))
+        first.delete(report=False)
+        self.assertEqual((acme.employees_count, other.employees_count), (1, 0))
+
+        models.Company.query.update({'employees_count': 42})
+        models.Employee.recount()
+        self.assertEqual((acme.employees_count, other.employees_count), (1, 0))
+
+    def test_hierarchy(self):
+        a, b, c, d = [models.Group.create(abbr=abbr, report=False) for abbr in 'ABCD']
+        a.children.append(b)
+        b.children.append(c)
+        c.parents.append(a)
+        c.children.append(d)
+        models.db.session.commit()
+
+        def abbrs(query):
+            return sorted(group.abbr for group in query)
+
+        self.assertEqual(abbrs(models.Group.descendants(a)), ['B', 'C', 'D'])
+        self.assertEqual(abbrs(models.Group.descendants(a, max_depth=1)), ['B', 'C'])
+        self.assertEqual(abbrs(models.Group.ancestors(d.id)), ['A', 'B', 'C'])
+        self.assertTrue(models.Group.path_exists(b, d))
+        self.assertFalse(models.Group.path_exists(d, b))
+        self.assertFalse(models.Group.path_exists(b, d, max_depth=1))
+
+        # a cycle does not make a node its own descendant
+        d.children.append(a)
+        models.db.session.commit()
+        self.assertFalse(models.Group.path_exists(a, a))
+        self.assertEqual(abbrs(models.Group.descendants(a)), ['B', 'C', 'D'])
+        recursive = dict(models.Group.hierarchies, children=models.Group.hierarchies['children']
+                         ._replace(closure=None))
+        with mock.patch.object(models.Group, 'hierarchies', recursive):
+            self.assertFalse(models.Group.path_exists(a, a))
+            self.assertEqual(abbrs(models.Group.descendants(a)), ['B', 'C', 'D'])
+        d.children.remove(a)
+        models.db.session.commit()
+
+        # the recursive query (without closure table) agrees
+        hierarchy = models.Group.hierarchies['children']._replace(closure=None)
+        self.assertEqual(abbrs(models.Group.query.filter(
+            models.Group.id.in_(hierarchy.reachable(a.id, max_depth=2)))), ['B', 'C', 'D'])
+
+        b.children.remove(c)
+        c.parents.remove(a)
+        models.db.session.commit()
+        self.assertEqual(abbrs(models.Group.descendants(a)), ['B'])
+        self.assertEqual(abbrs(models.Group.ancestors(d)), ['C'])
+
+    def test_counter_cache_expired(self):
+        acme = models.Company.create(name='ACME', report=False)
+        other = models.Company.create(name='Other', report=False)
+        employee = models.Employee.create(email='first', company=acme, report=False)
+
+        models.db.session.rollback()  # expires everything, including employee.company_id
+        employee.update(company=other, report=False)
+        self.assertEqual((acme.employees_count, other.employees_count), (0, 1))
+
+        models.db.session.rollback()
+        employee.delete(report=False)
+        self.assertEqual((acme.employees_count, other.employees_count), (0, 0))
+
+    def closure_rows(self):
+        closure = models.Group.hierarchies['children'].closure
+        return sorted(tuple(row) for row in models.db.session.execute(
+            models.db.select([closure.c.ancestor_id, closure.c.descendant_id, closure.c.depth])))
+
+    def assert_closure_consistent(self):
+        models.db.session.commit()
+        maintained = self.closure_rows()
+        models.Group.rebuild_closure()
+        self.assertEqual(maintained, self.closure_rows())
+
+    def test_closure(self):
+        closure = models.Group.hierarchies['children'].closure
+        assert_consistent = self.assert_closure_consistent
+
+        a, b, c, d, e = [models.Group.create(abbr=abbr, report=False) for abbr in 'ABCDE']
+        a.children.append(b)
+        b.children.append(c)
+        c.children.append(d)
+        assert_consistent()
+        a.children.append(d)  # shortcut lowers the depth of A -> D
+        d.children.append(e)
+        assert_consistent()
+        self.assertEqual(models.Group.descendants(a, max_depth=2).count(), 4)
+
+        b.children.remove(c)
+        assert_consistent()
+        self.assertEqual(sorted(g.abbr for g in models.Group.ancestors(e)), ['A', 'C', 'D'])
+        d.delete(report=False)
+        assert_consistent()
+        self.assertEqual(models.Group.ancestors(e).count(), 0)
+
+        # the sessions of transaction maintain it too
+        with models.db.transaction():
+            models.Group.query.get(b.id).children.append(models.Group.query.get(e.id))
+            models.db.session.commit()
+            self.assertTrue(models.Group.path_exists(a, e))
+
+        def plan(hierarchy, up):
+            query = hierarchy.reachable(a.id, up=up).compile(
+                compile_kwargs=dict(literal_binds=True))
+            return ' '.join(row[-1] for row in
+                            models.db.session.execute('EXPLAIN QUERY PLAN %s' % query))
+
+        hierarchy = models.Group.hierarchies['children']
+        self.assertIn('INDEX ix_%s_ancestor' % closure.name, plan(hierarchy, False))
+        self.assertIn('INDEX ix_%s_descendant' % closure.name, plan(hierarchy, True))
+        edges = hierarchy.model.__tablename__
+        self.assertIn('INDEX ix_%s_source' % edges, plan(hierarchy._replace(closure=None), False))
+        self.assertIn('INDEX ix_%s_target' % edges, plan(hierarchy._replace(closure=None), True))
+
+    def test_closure_bulk(self):
+        a = models.Group.create(abbr='A', report=False)
+        models.Group.bulk_insert([dict(abbr='H')])
+        writer = models.db.writer()
+        models.Group.create_async_buffered(abbr='W')
+        writer.close()
+        for abbr in 'HW':
+            a.children.append(models.Group.get_by('abbr', abbr))
+        self.assert_closure_consistent()
+        self.assertEqual(sorted(g.abbr for g in models.Group.descendants(a)), ['H', 'W'])
@@ -0,0 +1,73 @@
+from sqlangelo import SQLAngelo
+from tests import models
+import flask
+import pytest
+import queue
+import threading
+import time
+import unittest
+
+
+@pytest.mark.usefixtures('db_snapshot')
+class TestBufferedWriter(unittest.TestCase):
+
+    def test_create_async_buffered(self):
+        writer = models.db.writer(batch_size=2, flush_interval=0.01)
+        company = models.Company.create(name='ACME', report=False)
+        for i in range(3):
+            models.Employee.create_async_buffered(email='e%s' % i, company=company, salary=i)
+        writer.close()
+        stats = writer.stats()
+        self.assertEqual((stats['written'], stats['batches'], stats['queue_depth']), (3, 2, 0))
+        employees = models.User.query.all()  # polymorphic, so these must be Employees
+        self.assertEqual([e.company for e in employees], [company] * 3)
+        models.db.session.refresh(company)  # counted by the writer's own session
+        self.assertEqual(company.employees_count, 3)
+
+    def test_on_error(self):
+        failures = []
+        writer = models.db.writer(on_error=lambda batch, e: failures.extend(batch))
+        models.Group.create_async_buffered(abbr=None)  # violates NOT NULL
+        writer.close()
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(writer.stats()['failed'], 1)
+
+    def test_backpressure_and_flush(self):
+        writer = models.db.writer(batch_size=1, max_queue=1)
+        release = threading.Event()
+        insert = writer._insert
+
+        def slow_insert(*args):
+            release.wait()
+            insert(*args)
+
+        writer._insert = slow_insert
+        models.Group.create_async_buffered(abbr='A')
+        while writer.stats()['queue_depth']:  # until the writer is busy with it
+            time.sleep(0.01)
+        models.Group.create_async_buffered(abbr='B')
+        with self.assertRaises(queue.Full):
+            models.Group.create_async_buffered(abbr='C', timeout=0.05)
+        release.set()
+        writer.flush()
+        self.assertEqual(writer.stats()['written'], 2)
+        writer.close()
+        with self.assertRaises(RuntimeError):
+            writer.put(models.Group, dict(abbr='D'))
+
+    def test_pending_reference(self):
+        company = models.Company.create(name='Pending', commit=False, report=False)
+        with self.assertRaises(ValueError):
+            models.Employee.create_async_buffered(email='e', company=company)
+
+    def test_options_of_running_writer(self):
+        writer = models.db.writer(batch_size=5)
+        self.assertIs(models.db.writer(), writer)
+        with self.assertRaises(ValueError):
+            models.db.writer(batch_size=99)
+        writer.close()
+
+    def test_shared_connection(self):
+        db = SQLAngelo(flask.Flask('In memory'), 'sqlite://')
+        with self.assertRaises(ValueError):
+            db.writer()
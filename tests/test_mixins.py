@@ -0,0 +1,34 @@
+from decimal import Decimal
+from tests import models
+import pytest
+import unittest
+
+
+@pytest.mark.usefixtures('db_snapshot')
+class TestOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.company = models.Company.create(name='ACME', report=False)
+        self.other = models.Company.create(name='Other', report=False)
+        for salary in (1000, 2500):
+            models.Employee.create(email='e%s' % salary, salary=salary, company=self.company,
+                                   report=False)
+
+    def test_aggregate(self):
+        totals = models.Employee.aggregate(count='*', sum='salary', group_by='company_id')
+        self.assertEqual(totals, {self.company.id: {'count': 2, 'sum': Decimal('3500.00')}})
+        self.assertEqual(models.Employee.aggregate(models.Employee.salary > 2000, max='salary'),
+                         {'max': Decimal('2500.00')})
+        self.assertEqual(models.Employee.aggregate(low=('min', 'salary'), high=('max', 'salary')),
+                         {'low': Decimal('1000.00'), 'high': Decimal('2500.00')})
+        for aggregates in (dict(cout='*'), dict(total=('median', 'salary'))):
+            with self.assertRaises(ValueError):
+                models.Employee.aggregate(**aggregates)
+
+    def test_count_by(self):
+        self.assertEqual(models.Company.count_by('employees', ids=[self.company.id, self.other.id]),
+                         {self.company.id: 2, self.other.id: 0})
+        self.assertEqual(models.Company.count_by('employees'), {self.company.id: 2})
+        self.assertEqual(models.Group.count_by('users'), {})
+        with self.assertRaises(ValueError):
+            models.Employee.count_by('company')
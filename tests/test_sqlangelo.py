@@ -0,0 +1,127 @@
+from sqlalchemy.pool import QueuePool
+from sqlangelo import SQLAngelo, decorators
+from tests import models
+import flask
+import os
+import pytest
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+@pytest.mark.usefixtures('db_snapshot')
+class TestSQLAngelo(unittest.TestCase):
+
+    def test_worker_session(self):
+        db = models.db
+        with db.worker_session():
+            models.Group.create(abbr='WRK', report=False)
+            self.assertEqual(db.identity_map_size(), 0)
+        group = models.Group.create(abbr='WRK', report=False)
+        self.assertIn(group, db.session)
+        self.assertTrue(db.identity_map_size() > 0)
+
+    def test_worker_session_update(self):
+        db = models.db
+        with db.worker_session():
+            group = models.Group.create(abbr='NEW', report=False)
+            group.update(abbr='DONE', report=False)
+            self.assertEqual(db.session.query(models.Group.abbr)
+                             .filter_by(id=group.id).scalar(), 'DONE')
+            group.delete(report=False)
+            self.assertIsNone(models.Group.get(group.id))
+
+    def test_worker_session_cap(self):
+        db = models.db
+        db.session.expunge_all()
+        with db.worker_session(max_objects=2):
+            groups = [models.Group.create(abbr='CAP', report=False) for _ in range(2)]
+            self.assertEqual(db.identity_map_size(), 2)
+            groups.append(models.Group.create(abbr='CAP', report=False))
+            self.assertEqual(db.identity_map_size(), 0)
+
+    def test_sqlite_profile(self):
+        db = SQLAngelo(flask.Flask('SQLite profile'), 'sqlite://',
+                       sqlite_profile=dict(cache_size=-1024))
+        pragma = lambda name: db.engine.execute('PRAGMA %s' % name).scalar()  # noqa: E731
+        self.assertEqual(pragma('cache_size'), -1024)
+        self.assertEqual(pragma('temp_store'), 2)  # MEMORY
+        self.assertEqual(pragma('busy_timeout'), 5000)
+
+    def test_sqlite_profile_file(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        uri = 'sqlite:///' + os.path.join(folder, 'db.sqlite3')
+        db = SQLAngelo(flask.Flask('SQLite file'), uri, sqlite_profile=True)
+
+        class Item(db.BaseModel):
+            pass
+
+        db.create_all()
+        self.assertIsInstance(db.engine.pool, QueuePool)
+        self.assertEqual(db.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+        # a second writer waits (busy_timeout) for the first instead of failing
+        first, second = db.engine.connect(), db.engine.connect()
+        self.assertEqual(first.connection.isolation_level, 'IMMEDIATE')
+        transaction = first.begin()
+        first.execute(Item.__table__.insert())
+        threading.Timer(0.2, transaction.commit).start()
+        start = time.time()
+        second.execute(Item.__table__.insert())
+        self.assertGreaterEqual(time.time() - start, 0.15)
+        first.close()
+        second.close()
+        self.assertEqual(db.engine.execute('SELECT count(*) FROM item').scalar(), 2)
+
+    def test_query_stats(self):
+        db = SQLAngelo(flask.Flask('Profile'), 'sqlite://', slow_query_threshold=0)
+
+        class Item(db.BaseModel):
+            pass
+
+        db.create_all()
+        with self.assertLogs('sqlangelo.profiling', 'WARNING') as logs:
+            item = Item.create(report=False)
+            Item.get_by('id', item.id)
+            Item.query.all()
+        self.assertIn('SCAN', logs.output[-1])  # query plan of the full table scan
+        stats = db.query_stats()
+        self.assertEqual(stats[('Item', 'create')]['affected_rows'], 1)
+        self.assertEqual(stats[('Item', 'get_by')]['count'], 1)
+        self.assertEqual(stats[('Item', 'query')]['count'], 1)
+        db.reset_query_stats()
+        self.assertEqual(db.query_stats(), {})
+
+        db.profiler.sample_size = 2  # only for the percentiles
+        for _ in range(5):
+            Item.get_by('id', item.id)
+        self.assertEqual(db.query_stats()[('Item', 'get_by')]['count'], 5)
+        self.assertEqual(len(db.profiler.timings[('Item', 'get_by')][3]), 2)
+
+    def test_query_stats_hierarchy(self):
+        db = SQLAngelo(flask.Flask('Profile hierarchy'), 'sqlite://', profile=True)
+
+        @decorators.add_cross_reference(names=('parent', 'child'))
+        class Node(db.BaseModel):
+            pass
+
+        db.create_all()
+        parent, child = Node.create(report=False), Node.create(report=False)
+        parent.children.append(child)
+        db.session.commit()
+        db.reset_query_stats()
+        Node.descendants(parent).all()
+        Node.path_exists(parent, child)
+        self.assertEqual(sorted(db.query_stats()), [('Node', 'path_exists'), ('Node', 'query')])
+
+    def test_query_stats_off(self):
+        with self.assertRaises(RuntimeError):
+            models.db.query_stats()
+
+    def test_restore_without_snapshot(self):
+        db = SQLAngelo(flask.Flask('Snapshot'), 'sqlite://')
+        with self.assertRaises(RuntimeError):
+            db.restore()
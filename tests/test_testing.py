@@ -0,0 +1,37 @@
+from tests import models
+import pytest
+import unittest
+
+
+class ResetTests(object):
+
+    def create_company(self):
+        models.Company.create(name='Test', report=False)
+        self.assertEqual(models.Company.query.count(), 2)
+
+    def test_first(self):
+        self.create_company()
+
+    def test_second(self):
+        self.create_company()
+
+
+@pytest.mark.usefixtures('db_snapshot')
+class TestSnapshot(ResetTests, unittest.TestCase):
+    pass
+
+
+@pytest.mark.usefixtures('db_schema')
+class TestWithoutReset(unittest.TestCase):
+
+    def test_leave_behind(self):  # the next tests still start from the seeded database
+        models.Company.create(name='Left behind', report=False)
+
+
+@pytest.mark.usefixtures('db_transaction')
+class TestTransaction(ResetTests, unittest.TestCase):
+
+    def test_rollback(self):
+        models.Company.create(name='Rolled back', commit=False, report=False)
+        models.db.session.rollback()
+        self.create_company()
@@ -0,0 +1,36 @@
+from decimal import Decimal
+from sqlangelo import types
+from tests import models
+import pytest
+import unittest
+
+
+@pytest.mark.usefixtures('db_snapshot')
+class TestTypes(unittest.TestCase):
+
+    def test_fast_money(self):
+        money = types.FastMoneyType()
+        self.assertEqual(money.process_bind_param(1234, None), 1234)
+        self.assertEqual(money.process_bind_param(None, None), None)
+        for value in (Decimal('1000'), 1000.0, '10.00', True):
+            with self.assertRaises(TypeError):
+                money.process_bind_param(value, None)
+
+    def test_units(self):
+        self.assertEqual(types.to_units(Decimal('12.345')), 1235)
+        self.assertEqual(types.to_units(0.1), 10)
+        self.assertEqual(types.to_units('1.5', scale=4), 15000)
+        self.assertEqual(types.to_units(1000), 100000)
+        self.assertEqual(types.from_units([1234, None, 5]),
+                         [Decimal('12.34'), None, Decimal('0.05')])
+        self.assertEqual(types.sum_units([1234, None, 5]), Decimal('12.39'))
+
+    def test_migrate_to_units(self):
+        db = models.db
+        company = models.Company.create(name='ACME', report=False)
+        for salary in (Decimal('1000.25'), None):
+            models.Employee.create(email='e', salary=salary, company=company, report=False)
+        salary = models.Employee.__table__.c.salary
+        with db.engine.begin() as connection:
+            self.assertEqual(types.migrate_to_units(connection, salary), 1)
+        self.assertEqual(sorted(db.session.query(salary).all(), key=str), [(100025,), (None,)])